@@ -1,55 +1,56 @@
 import asyncio
 import os
+import struct
+import sys
 import time
 from bleak import BleakScanner
-from collections import deque
 
 # --- Configuración ---
 # Tiempo en segundos para que una baliza desaparezca si no se detecta
 BEACON_TIMEOUT = 10
-# Número de lecturas de RSSI a promediar para suavizar la señal
-RSSI_SAMPLES_COUNT = 10
+# Factor del filtro exponencial (ARMA) para suavizar la señal RSSI
+ARMA_SMOOTHING = 0.1
 # Umbral (en dBm) para considerar un cambio de estado (movimiento)
 TREND_THRESHOLD = 1.5
 
+# Campos del iBeacon tras el prefijo 0x02 0x15: UUID (16 bytes), Major y Minor (big-endian)
+_IBEACON_STRUCT = struct.Struct('>16sHH')
+
 # Diccionario para almacenar los datos de cada baliza
 detected_beacons = {}
 
 def clear_screen():
-    """Limpia la pantalla de la terminal."""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    """Limpia la pantalla de la terminal con secuencias ANSI (cursor al inicio + borrar)."""
+    sys.stdout.write('\x1b[H\x1b[2J')
+    sys.stdout.flush()
 
 async def main():
     def detection_callback(device, advertising_data):
         """Esta función se llama con cada detección y solo recolecta datos."""
-        manufacturer_data = advertising_data.manufacturer_data
-        
-        # 1. Primero, verificamos si la clave de Apple existe.
-        if 0x004c in manufacturer_data:
-            # 2. Si existe, AHORA SÍ creamos la variable 'beacon_data'.
-            beacon_data = manufacturer_data[0x004c]
-            
-            # 3. Ahora que 'beacon_data' existe, ya podemos usarla en la siguiente condición.
-            if beacon_data[0:2] == b'\x02\x15':
-                beacon_data = manufacturer_data[0x004c]
-                device_key = device.address
+        # 1. Buscamos los datos de fabricante de Apple (0x004c), si existen.
+        beacon_data = advertising_data.manufacturer_data.get(0x004c)
 
+        # 2. Solo nos interesan los iBeacon (prefijo 0x02 0x15) con la trama completa de 22 bytes.
+        if beacon_data is not None and len(beacon_data) >= 22 and beacon_data[0] == 0x02 and beacon_data[1] == 0x15:
+            device_key = device.address
+
+            # Si es la primera vez que vemos este dispositivo, creamos su entrada
+            data = detected_beacons.get(device_key)
+            if data is None:
+                uuid, major, minor = _IBEACON_STRUCT.unpack_from(beacon_data, 2)
+                data = detected_beacons[device_key] = {
+                    'uuid': uuid.hex(),
+                    'major': major,
+                    'minor': minor,
+                    'avg_rssi': advertising_data.rssi,
+                    'prev_avg_rssi': None,
+                    'trend': 'Calculando...'
+                }
+            else:
+                # Suavizamos la señal con el filtro exponencial
+                data['avg_rssi'] += ARMA_SMOOTHING * (advertising_data.rssi - data['avg_rssi'])
 
-                # Si es la primera vez que vemos este dispositivo, creamos su entrada
-                if device_key not in detected_beacons:
-                    detected_beacons[device_key] = {
-                        'uuid': beacon_data[2:18].hex(),
-                        'major': int.from_bytes(beacon_data[18:20], 'big'),
-                        'minor': int.from_bytes(beacon_data[20:22], 'big'),
-                        'readings': deque(maxlen=RSSI_SAMPLES_COUNT),
-                        'avg_rssi': None,
-                        'prev_avg_rssi': None,
-                        'trend': 'Calculando...'
-                    }
-                
-                # Añadimos la nueva lectura de RSSI y actualizamos la hora
-                detected_beacons[device_key]['readings'].append(advertising_data.rssi)
-                detected_beacons[device_key]['last_seen'] = time.time()
+            data['last_seen'] = time.monotonic()
 
     # Iniciar el escaneo en segundo plano
     scanner = BleakScanner(detection_callback)
@@ -58,36 +59,32 @@ async def main():
     try:
         # Bucle principal para procesar datos y dibujar la pantalla
         while True:
-            current_time = time.time()
+            current_time = time.monotonic()
             
             # Procesar cada baliza detectada
-            for key, data in list(detected_beacons.items()):
-                # Eliminar balizas que no se han visto recientemente
+            expired_keys = []
+            for key, data in detected_beacons.items():
+                # Las balizas que no se han visto recientemente se eliminan al final
                 if current_time - data['last_seen'] > BEACON_TIMEOUT:
-                    del detected_beacons[key]
+                    expired_keys.append(key)
                     continue # Pasar a la siguiente iteración
 
-                # --- Lógica de Promedio y Tendencia ---
-                readings = data['readings']
-                if len(readings) > 0:
-                    # 1. Suavizar la señal (Averaging)
-                    new_avg = sum(readings) / len(readings)
+                # --- Lógica de Tendencia ---
+                # El promedio ya se suaviza en cada detección; aquí solo
+                # nos enfocamos en el cambio (Delta) desde el ciclo anterior.
+                if data['prev_avg_rssi'] is not None:
+                    delta = data['avg_rssi'] - data['prev_avg_rssi']
                     
-                    # Guardamos el promedio anterior antes de actualizarlo
-                    if data['avg_rssi'] is not None:
-                        data['prev_avg_rssi'] = data['avg_rssi']
-                    data['avg_rssi'] = new_avg
+                    if delta > TREND_THRESHOLD:
+                        data['trend'] = 'Acercándose ⬆️'
+                    elif delta < -TREND_THRESHOLD:
+                        data['trend'] = 'Alejándose ⬇️'
+                    else:
+                        data['trend'] = 'Estable ⏸️'
+                data['prev_avg_rssi'] = data['avg_rssi']
 
-                    # 2. Enfocarse en el cambio (Delta)
-                    if data['prev_avg_rssi'] is not None:
-                        delta = data['avg_rssi'] - data['prev_avg_rssi']
-                        
-                        if delta > TREND_THRESHOLD:
-                            data['trend'] = 'Acercándose ⬆️'
-                        elif delta < -TREND_THRESHOLD:
-                            data['trend'] = 'Alejándose ⬇️'
-                        else:
-                            data['trend'] = 'Estable ⏸️'
+            for key in expired_keys:
+                del detected_beacons[key]
             
             # --- Lógica para Dibujar la Pantalla ---
             clear_screen()
@@ -112,4 +109,7 @@ async def main():
         print("✅ Script finalizado.")
 
 if __name__ == "__main__":
+    if os.name == 'nt':
+        # Habilita el soporte de secuencias ANSI en la consola clasica de Windows
+        os.system('')
     asyncio.run(main())
\ No newline at end of file
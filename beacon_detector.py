@@ -1,12 +1,16 @@
 import flet as ft
 import time
 import threading
-import statistics
+import queue
 from collections import deque
 from bleak import BleakScanner
 import asyncio
+import bisect
 import os
+import struct
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 import math
 
@@ -15,17 +19,48 @@ load_dotenv()
 
 # --- Configuracion del Escaner y la App ---
 BEACON_TIMEOUT = 15
-RSSI_SAMPLES_COUNT = 10
+ARMA_SMOOTHING = 0.1  # Factor del filtro exponencial para suavizar el RSSI
 CALIBRATION_DURATION = 10  # Segundos
 
-# Objeto de estado compartido entre hilos
+# --- Configuracion del Mapa ---
+MAP_SIZE = 400
+MAP_CENTER = MAP_SIZE / 2
+UNIFIED_MAP_RADIUS = MAP_SIZE / 2 - 10
+DEG2RAD = math.pi / 180
+MAP_RSSI_MIN, MAP_RSSI_MAX = -95, -35  # RSSI en el borde y en el centro del mapa
+BEACON_DOT_SIZE = 20
+# Esquina superior izquierda del punto de una baliza situada en el centro
+DOT_ORIGIN = MAP_CENTER - BEACON_DOT_SIZE / 2
+
+# Estados de una baliza, guardados como indices de STATUS_NAMES y STATUS_COLORS
+NUEVO, CALIBRANDO, ZONA_1, ZONA_2, ZONA_3, FUERA = range(6)
+STATUS_NAMES = ("NUEVO", "CALIBRANDO", "ZONA 1", "ZONA 2", "ZONA 3", "FUERA")
+STATUS_COLORS = (
+    ft.Colors.GREY, ft.Colors.BLUE,
+    ft.Colors.GREEN_ACCENT, ft.Colors.YELLOW_ACCENT,
+    ft.Colors.ORANGE_ACCENT, ft.Colors.RED_ACCENT
+)
+
+def map_rssi_to_distance(rssi, map_radius=UNIFIED_MAP_RADIUS):
+    """Convierte un RSSI en distancia al centro del mapa (mas debil, mas lejos)."""
+    normalized_rssi = max(0, min(1, (rssi - MAP_RSSI_MIN) / (MAP_RSSI_MAX - MAP_RSSI_MIN)))
+    return (1 - normalized_rssi) * map_radius
+
+# Campos del iBeacon tras el prefijo 0x02 0x15: UUID (16 bytes), Major y Minor
+_IBEACON_STRUCT = struct.Struct('>16sHH')
+
+# Objeto de estado de la app; solo se modifica desde el bucle de eventos de asyncio
 APP_STATE = {
     "mode": "IDLE",  # Estados: IDLE, CALIBRATING, MONITORING
     "calibration_end_time": 0,
     "detected_beacons": {},
-    "perimeter_rssi_levels": [] # Lista para guardar los 3 niveles de RSSI del perimetro
+    "perimeter_rssi_levels": [], # Lista para guardar los 3 niveles de RSSI del perimetro
+    "zone_thresholds": [] # Los mismos niveles en orden ascendente, para clasificar con bisect
 }
 
+# Zona segun el numero de umbrales (exterior, medio, interior) que supera el RSSI
+ZONE_STATUSES = (FUERA, ZONA_3, ZONA_2, ZONA_1)
+
 DB_CONFIG = {
     "host": os.getenv("DB_HOST"),
     "port": os.getenv("DB_PORT"),
@@ -35,56 +70,89 @@ DB_CONFIG = {
     "client_encoding": os.getenv("DB_CLIENT_ENCODING", "utf8")
 }
 
+# Eventos de zona pendientes de insertar; los consume db_writer_thread en lotes
+event_q = queue.Queue()
+DB_BATCH_SIZE = 100
+DB_FLUSH_INTERVAL = 1.0  # Segundos
+
 def log_zone_change_event(mac_address, old_zone, new_zone, logger):
-    """Registra un cambio de zona en la tabla de eventos."""
+    """Encola un cambio de zona para registrarlo en la tabla de eventos."""
     logger(f"DB: Registrando evento de zona para {mac_address}...")
-    conn = None
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        with conn.cursor() as cur:
-            mensaje = f"Alerta: Baliza {mac_address} cambio de zona {old_zone} a {new_zone}."
-            cur.execute("INSERT INTO eventos (mensaje) VALUES (%s)", (mensaje,))
+    mensaje = f"Alerta: Baliza {mac_address} cambio de zona {old_zone} a {new_zone}."
+    event_q.put((mac_address, mensaje))
+
+def db_writer_thread(logger):
+    """Hilo que inserta los eventos encolados en lotes usando un pool de conexiones."""
+    db_pool = None
+    while True:
+        batch = [event_q.get()]
+        deadline = time.monotonic() + DB_FLUSH_INTERVAL
+        while len(batch) < DB_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(event_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        conn = None
+        failed = False
+        try:
+            if db_pool is None:
+                db_pool = psycopg2.pool.ThreadedConnectionPool(1, 5, **DB_CONFIG)
+            conn = db_pool.getconn()
+            with conn.cursor() as cur:
+                # execute_values reescribe el lote como un solo INSERT ... VALUES (...), (...)
+                execute_values(
+                    cur, "INSERT INTO eventos (mensaje) VALUES %s",
+                    [(mensaje,) for _, mensaje in batch], page_size=DB_BATCH_SIZE
+                )
             conn.commit()
-            logger(f"DB: OK - Evento registrado para {mac_address}.")
-    except Exception as e:
-        logger(f"DB: ERROR al registrar evento para {mac_address}: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def ble_scanner_thread():
-    """Hilo de escaneo que solo se encarga de recolectar datos."""
-    
-    def detection_callback(device, advertising_data):
-        manufacturer_data = advertising_data.manufacturer_data
-        if 0x004c in manufacturer_data:
-            beacon_data = manufacturer_data[0x004c]
-            if beacon_data[0:2] == b'\x02\x15':
-                device_key = device.address
-                
-                with threading.Lock():
-                    if device_key not in APP_STATE["detected_beacons"]:
-                        APP_STATE["detected_beacons"][device_key] = {
-                            'uuid': beacon_data[2:18].hex(),
-                            'name': device.name if device.name else "Desconocido",
-                            'readings': deque(maxlen=RSSI_SAMPLES_COUNT),
-                            'avg_rssi': -100,
-                            'home_rssi': None,
-                            'status': 'NUEVO'
-                        }
-                    
-                    APP_STATE["detected_beacons"][device_key]['readings'].append(advertising_data.rssi)
-                    APP_STATE["detected_beacons"][device_key]['last_seen'] = time.time()
-
-    async def scan_loop():
-        scanner = BleakScanner(detection_callback)
-        await scanner.start()
-        while True:
-            await asyncio.sleep(0.2)
+            for mac_address, _ in batch:
+                logger(f"DB: OK - Evento registrado para {mac_address}.")
+        except Exception as e:
+            failed = True
+            for mac_address, _ in batch:
+                logger(f"DB: ERROR al registrar evento para {mac_address}: {e}")
+        finally:
+            if conn:
+                # Una conexion que fallo no se devuelve al pool para reutilizarla
+                db_pool.putconn(conn, close=failed)
 
-    asyncio.run(scan_loop())
+# Cola de anuncios BLE pendientes de procesar en el siguiente ciclo de la UI
+adv_queue = deque()
 
-def main(page: ft.Page):
+def process_advertisements(now):
+    """Vuelca en APP_STATE los anuncios encolados; todo el lote se marca con la hora `now`."""
+    beacons = APP_STATE["detected_beacons"]
+    while adv_queue:
+        device_key, name, beacon_data, rssi = adv_queue.popleft()
+        data = beacons.get(device_key)
+        if data is None:
+            uuid, _major, _minor = _IBEACON_STRUCT.unpack_from(beacon_data, 2)
+            # La MAC no cambia, asi que el angulo en el mapa se calcula una sola vez
+            angle = (hash(device_key) % 360) * DEG2RAD
+            data = beacons[device_key] = {
+                'uuid': uuid.hex(),
+                'name': name if name else "Desconocido",
+                'avg_rssi': rssi,
+                'home_rssi': None,
+                'status_idx': NUEVO,
+                'cos_a': math.cos(angle),
+                'sin_a': math.sin(angle)
+            }
+        else:
+            data['avg_rssi'] += ARMA_SMOOTHING * (rssi - data['avg_rssi'])
+        data['last_seen'] = now
+
+def detection_callback(device, advertising_data):
+    """Callback del escaner: solo filtra iBeacons y los encola."""
+    beacon_data = advertising_data.manufacturer_data.get(0x004c)
+    if beacon_data is not None and len(beacon_data) >= 22 and beacon_data[0] == 0x02 and beacon_data[1] == 0x15:
+        adv_queue.append((device.address, device.name, beacon_data, advertising_data.rssi))
+
+async def main(page: ft.Page):
     page.title = "Mapa de Perimetro Dinamico BLE"
     page.horizontal_alignment = ft.CrossAxisAlignment.CENTER
     page.bgcolor = "#1f262f"
@@ -103,30 +171,25 @@ def main(page: ft.Page):
         except Exception as e:
             print(f"[APP LOG] CRITICAL: Falla al actualizar la UI del log. Error: {e}")
 
-    def start_calibration(e):
+    async def start_calibration(e):
         APP_STATE["mode"] = "CALIBRATING"
-        APP_STATE["calibration_end_time"] = time.time() + CALIBRATION_DURATION
+        APP_STATE["calibration_end_time"] = time.monotonic() + CALIBRATION_DURATION
         APP_STATE["perimeter_rssi_levels"] = []
+        APP_STATE["zone_thresholds"] = []
         for data in APP_STATE["detected_beacons"].values():
             data['home_rssi'] = None
-            data['status'] = 'CALIBRANDO'
+            data['status_idx'] = CALIBRANDO
         calibrate_button.disabled = True
         add_log_message("Iniciando calibracion...")
         
-    def map_rssi_to_distance(rssi, map_radius):
-        rssi_min, rssi_max = -95, -35
-        normalized_rssi = max(0, min(1, (rssi - rssi_min) / (rssi_max - rssi_min)))
-        return (1 - normalized_rssi) * map_radius
-
     txt_status = ft.Text("Presiona 'Iniciar Calibracion' para definir el perimetro.", size=16, weight=ft.FontWeight.BOLD)
     calibrate_button = ft.ElevatedButton("Iniciar Calibracion", on_click=start_calibration, icon=ft.Icons.SETTINGS_INPUT_COMPONENT)
     
-    MAP_SIZE = 400
     map_stack = ft.Stack(
         width=MAP_SIZE,
         height=MAP_SIZE,
         controls=[
-            ft.Container(width=MAP_SIZE, height=MAP_SIZE, border=ft.border.all(1, ft.Colors.BLUE_GREY_900), border_radius=ft.border_radius.all(MAP_SIZE/2)),
+            ft.Container(width=MAP_SIZE, height=MAP_SIZE, border=ft.border.all(1, ft.Colors.BLUE_GREY_900), border_radius=ft.border_radius.all(MAP_CENTER)),
             ft.Icon(ft.Icons.MY_LOCATION, color=ft.Colors.CYAN, size=30)
         ]
     )
@@ -157,130 +220,140 @@ def main(page: ft.Page):
         )
     )
 
-    def ui_update_loop():
-        while True:
-            current_time = time.time()
-            
-            beacons_to_process = list(APP_STATE["detected_beacons"].items())
-
-            for key, data in beacons_to_process:
-                if current_time - data.get('last_seen', 0) > BEACON_TIMEOUT:
-                    if key in APP_STATE["detected_beacons"]:
-                        del APP_STATE["detected_beacons"][key]
-                    continue
-                
-                if data['readings']:
-                    data['avg_rssi'] = statistics.mean(data['readings'])
-
-            if APP_STATE["mode"] == "CALIBRATING":
-                remaining_time = APP_STATE["calibration_end_time"] - current_time
-                if remaining_time > 0:
-                    txt_status.value = f"Calibrando... Definiendo perimetro en {remaining_time:.0f}s"
-                else:
-                    APP_STATE["mode"] = "MONITORING"
-                    txt_status.value = "Monitoreando. Perimetros definidos."
-                    calibrate_button.disabled = False
-                    add_log_message("Calibracion finalizada. Definiendo perimetros.")
-                    
-                    for data in APP_STATE["detected_beacons"].values():
-                        if data['avg_rssi'] is not None:
-                            data['home_rssi'] = data['avg_rssi']
-
-                    home_rssis = [d['home_rssi'] for d in APP_STATE["detected_beacons"].values() if d.get('home_rssi') is not None]
-                    
-                    p_inner, p_mid, p_outer = 0, 0, 0
-
-                    if home_rssis:
-                        weakest_rssi = min(home_rssis)
-                        p_inner = weakest_rssi - 5
-                        p_mid = p_inner - 15 
-                        p_outer = p_inner - 30
-                        add_log_message(f"Perimetros RSSI: Z1 > {p_inner:.1f}, Z2 > {p_mid:.1f}, Z3 > {p_outer:.1f}")
-
-                    p_inner = min(-35, p_inner)
-                    APP_STATE["perimeter_rssi_levels"] = sorted([p_inner, p_mid, p_outer], reverse=True)
-
-            elif APP_STATE["mode"] == "MONITORING":
-                if APP_STATE["perimeter_rssi_levels"]:
-                    p_inner, p_mid, p_outer = APP_STATE["perimeter_rssi_levels"]
-                    for key, data in APP_STATE["detected_beacons"].items():
-                        if data.get('avg_rssi') is not None:
-                            rssi = data['avg_rssi']
-                            old_status = data.get('status', 'NUEVO')
-                            new_status = old_status
-
-                            if rssi >= p_inner:
-                                new_status = 'ZONA 1'
-                            elif p_mid <= rssi < p_inner:
-                                new_status = 'ZONA 2'
-                            elif p_outer <= rssi < p_mid:
-                                new_status = 'ZONA 3'
-                            else:
-                                new_status = 'FUERA'
-                            
-                            if new_status != old_status:
-                                data['status'] = new_status
-                                add_log_message(f"Baliza {key} cambio de {old_status} a {new_status}.")
-                                if new_status == 'FUERA' or old_status == 'FUERA':
-                                    log_zone_change_event(key, old_status, new_status, add_log_message)
-            
-            map_stack.controls = map_stack.controls[:2]
-            
-            UNIFIED_MAP_RADIUS = MAP_SIZE / 2 - 10
-
-            if APP_STATE["perimeter_rssi_levels"]:
-                for rssi_level in APP_STATE["perimeter_rssi_levels"]:
-                    distance = map_rssi_to_distance(rssi_level, UNIFIED_MAP_RADIUS)
-                    size = distance * 2
-                    pos = (MAP_SIZE / 2) - distance
-                    perimeter_circle = ft.Container(
-                        width=size, height=size, left=pos, top=pos,
-                        border=ft.border.all(1, ft.Colors.BLUE_GREY_700),
-                        border_radius=ft.border_radius.all(distance)
-                    )
-                    map_stack.controls.append(perimeter_circle)
-
-            status_color_map = {
-                "NUEVO": ft.Colors.GREY, "CALIBRANDO": ft.Colors.BLUE,
-                "ZONA 1": ft.Colors.GREEN_ACCENT, "ZONA 2": ft.Colors.YELLOW_ACCENT,
-                "ZONA 3": ft.Colors.ORANGE_ACCENT, "FUERA": ft.Colors.RED_ACCENT
-            }
+    # Controles reutilizados entre ciclos: solo se crean o eliminan al aparecer/desaparecer balizas
+    beacon_dot_cache = {}
+    beacon_text_cache = {}
+    perimeter_circles = []
+    drawn_perimeter_levels = []
+    # La lista ordenada solo se reconstruye cuando aparecen o desaparecen balizas
+    beacon_keys_dirty = False
 
-            for key, data in APP_STATE["detected_beacons"].items():
-                if 'avg_rssi' not in data: continue
-                
-                status_color = status_color_map.get(data['status'], ft.Colors.GREY)
+    def discard_beacon_controls(key):
+        nonlocal beacon_keys_dirty
+        beacon_dot = beacon_dot_cache.pop(key, None)
+        if beacon_dot is not None:
+            map_stack.controls.remove(beacon_dot)
+        beacon_text_cache.pop(key, None)
+        beacon_keys_dirty = True
+
+    def update_tick():
+        nonlocal beacon_keys_dirty
+        current_time = time.monotonic()
+        process_advertisements(current_time)
+        
+        expired_keys = [
+            key for key, data in APP_STATE["detected_beacons"].items()
+            if current_time - data.get('last_seen', 0) > BEACON_TIMEOUT
+        ]
+        for key in expired_keys:
+            del APP_STATE["detected_beacons"][key]
+            discard_beacon_controls(key)
+
+        if APP_STATE["mode"] == "CALIBRATING":
+            remaining_time = APP_STATE["calibration_end_time"] - current_time
+            if remaining_time > 0:
+                txt_status.value = f"Calibrando... Definiendo perimetro en {remaining_time:.0f}s"
+            else:
+                APP_STATE["mode"] = "MONITORING"
+                txt_status.value = "Monitoreando. Perimetros definidos."
+                calibrate_button.disabled = False
+                add_log_message("Calibracion finalizada. Definiendo perimetros.")
                 
-                distance = map_rssi_to_distance(data['avg_rssi'], UNIFIED_MAP_RADIUS)
-                angle = (hash(key) % 360) * (math.pi / 180) 
+                for data in APP_STATE["detected_beacons"].values():
+                    if data['avg_rssi'] is not None:
+                        data['home_rssi'] = data['avg_rssi']
+
+                home_rssis = [d['home_rssi'] for d in APP_STATE["detected_beacons"].values() if d.get('home_rssi') is not None]
                 
-                x = (MAP_SIZE / 2) + distance * math.cos(angle)
-                y = (MAP_SIZE / 2) + distance * math.sin(angle)
+                p_inner, p_mid, p_outer = 0, 0, 0
 
-                beacon_dot = ft.Container(
-                    width=20, height=20, bgcolor=status_color, border_radius=10,
-                    left=x-10, top=y-10,
-                    tooltip=f"Nombre: {data.get('name', 'N/A')}\nMAC: {key}\nRSSI: {data['avg_rssi']:.1f} dBm\nStatus: {data['status']}"
+                if home_rssis:
+                    weakest_rssi = min(home_rssis)
+                    p_inner = weakest_rssi - 5
+                    p_mid = p_inner - 15 
+                    p_outer = p_inner - 30
+                    add_log_message(f"Perimetros RSSI: Z1 > {p_inner:.1f}, Z2 > {p_mid:.1f}, Z3 > {p_outer:.1f}")
+
+                p_inner = min(-35, p_inner)
+                APP_STATE["perimeter_rssi_levels"] = sorted([p_inner, p_mid, p_outer], reverse=True)
+                APP_STATE["zone_thresholds"] = APP_STATE["perimeter_rssi_levels"][::-1]
+
+        elif APP_STATE["mode"] == "MONITORING":
+            zone_thresholds = APP_STATE["zone_thresholds"]
+            if zone_thresholds:
+                for key, data in APP_STATE["detected_beacons"].items():
+                    if data.get('avg_rssi') is not None:
+                        old_status = data['status_idx']
+                        new_status = ZONE_STATUSES[bisect.bisect_right(zone_thresholds, data['avg_rssi'])]
+                        
+                        if new_status != old_status:
+                            data['status_idx'] = new_status
+                            old_name, new_name = STATUS_NAMES[old_status], STATUS_NAMES[new_status]
+                            add_log_message(f"Baliza {key} cambio de {old_name} a {new_name}.")
+                            if new_status == FUERA or old_status == FUERA:
+                                log_zone_change_event(key, old_name, new_name, add_log_message)
+        
+        if APP_STATE["perimeter_rssi_levels"] != drawn_perimeter_levels:
+            new_circles = []
+            for rssi_level in APP_STATE["perimeter_rssi_levels"]:
+                distance = map_rssi_to_distance(rssi_level)
+                size = distance * 2
+                pos = MAP_CENTER - distance
+                new_circles.append(ft.Container(
+                    width=size, height=size, left=pos, top=pos,
+                    border=ft.border.all(1, ft.Colors.BLUE_GREY_700),
+                    border_radius=ft.border_radius.all(distance)
+                ))
+            map_stack.controls[2:2 + len(perimeter_circles)] = new_circles
+            perimeter_circles[:] = new_circles
+            drawn_perimeter_levels[:] = APP_STATE["perimeter_rssi_levels"]
+
+        for key, data in APP_STATE["detected_beacons"].items():
+            status_color = STATUS_COLORS[data['status_idx']]
+            status_name = STATUS_NAMES[data['status_idx']]
+            distance = map_rssi_to_distance(data['avg_rssi'])
+            left = DOT_ORIGIN + distance * data['cos_a']
+            top = DOT_ORIGIN + distance * data['sin_a']
+            tooltip = f"Nombre: {data.get('name', 'N/A')}\nMAC: {key}\nRSSI: {data['avg_rssi']:.1f} dBm\nStatus: {status_name}"
+            list_text = f"{data.get('name', 'Desconocido')} ({key}) | RSSI: {data['avg_rssi']:.1f} dBm ({status_name})"
+
+            beacon_dot = beacon_dot_cache.get(key)
+            if beacon_dot is None:
+                beacon_dot = beacon_dot_cache[key] = ft.Container(
+                    width=BEACON_DOT_SIZE, height=BEACON_DOT_SIZE, border_radius=BEACON_DOT_SIZE / 2
                 )
                 map_stack.controls.append(beacon_dot)
+                beacon_text_cache[key] = ft.Text(weight=ft.FontWeight.W_500)
+                beacon_keys_dirty = True
+            beacon_dot.left = left
+            beacon_dot.top = top
+            beacon_dot.bgcolor = status_color
+            beacon_dot.tooltip = tooltip
 
-            beacons_list_view.controls.clear()
-            sorted_beacons = sorted(APP_STATE["detected_beacons"].items())
-
-            for key, data in sorted_beacons:
-                if 'avg_rssi' in data:
-                    text_color = status_color_map.get(data['status'], ft.Colors.GREY)
-                    beacons_list_view.controls.append(
-                        ft.Text(
-                            f"{data.get('name', 'Desconocido')} ({key}) | RSSI: {data['avg_rssi']:.1f} dBm ({data['status']})",
-                            color=text_color, weight=ft.FontWeight.W_500
-                        )
-                    )
-            
+            beacon_text = beacon_text_cache[key]
+            beacon_text.value = list_text
+            beacon_text.color = status_color
+
+        if beacon_keys_dirty:
+            beacons_list_view.controls = [beacon_text_cache[key] for key in sorted(beacon_text_cache)]
+            beacon_keys_dirty = False
+
+    async def ui_update_loop():
+        while True:
+            update_tick()
             page.update()
-            time.sleep(0.5)
+            await asyncio.sleep(0.5)
+
+    # Los logs del hilo de la base de datos se despachan al bucle de eventos de la UI
+    loop = asyncio.get_running_loop()
+    threading.Thread(
+        target=db_writer_thread,
+        args=(lambda message: loop.call_soon_threadsafe(add_log_message, message),),
+        daemon=True
+    ).start()
 
-    threading.Thread(target=ble_scanner_thread, daemon=True).start()
-    threading.Thread(target=ui_update_loop, daemon=True).start()
+    # El escaner y la UI comparten el bucle de eventos de Flet
+    async with BleakScanner(detection_callback):
+        await ui_update_loop()
 
 ft.app(target=main)
\ No newline at end of file